@@ -1,17 +1,44 @@
+import copy
+import functools
+import hashlib
 import io
+import itertools
 import json
+import os
 import re
+import struct
+import threading
 import time
 import zipfile
 import xml.etree.ElementTree as ET
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 from openpyxl import load_workbook
 from difflib import SequenceMatcher
 
+try:
+    from lxml import etree as LET   # optional: libxml2 parse/serialize for package parts
+except ImportError:
+    LET = None
+try:
+    from rapidfuzz import fuzz, process   # optional: C++ similarity for header suggestions
+except ImportError:
+    process = None
+try:
+    _ARROW_STR = pd.StringDtype("pyarrow")   # optional: Arrow string kernels for column cleaning
+except ImportError:
+    _ARROW_STR = None
+try:
+    from isal import isal_zlib as _deflate_lib   # optional: ISA-L deflate (zlib API, several times faster)
+except ImportError:
+    import zlib as _deflate_lib
+
 # ─────────────────────────────────────────────────────────────────────
 # Page meta + theming
 # ─────────────────────────────────────────────────────────────────────
@@ -46,26 +73,62 @@ XL_NS_REL  = "http://schemas.openxmlformats.org/officeDocument/2006/relationship
 ET.register_namespace("", XL_NS_MAIN)
 ET.register_namespace("r", XL_NS_REL)
 ET.register_namespace("mc", "http://schemas.openxmlformats.org/markup-compatibility/2006")
-ET.register_namespace("x14ac", "http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac")
-
-_INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\uD800-\uDFFF]")
-
-def sanitize_xml_text(s) -> str:
+XL_NS_X14AC = "http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac"
+ET.register_namespace("x14ac", XL_NS_X14AC)
+
+# Clark-notation tags the patchers look up (built once, not per call)
+_TAG_SHEET = f"{{{XL_NS_MAIN}}}sheet"
+_TAG_TABLE_COLUMNS = f"{{{XL_NS_MAIN}}}tableColumns"
+_TAG_TABLE_COLUMN = f"{{{XL_NS_MAIN}}}tableColumn"
+_TAG_SHEET_DATA = f"{{{XL_NS_MAIN}}}sheetData"
+_TAG_MERGE_CELLS = f"{{{XL_NS_MAIN}}}mergeCells"
+_TAG_DIMENSION = f"{{{XL_NS_MAIN}}}dimension"
+_TAG_AUTO_FILTER = f"{{{XL_NS_MAIN}}}autoFilter"
+_TAG_SHEET_PR = f"{{{XL_NS_MAIN}}}sheetPr"
+_TAG_ROW = f"{{{XL_NS_MAIN}}}row"
+_TAG_CELL = f"{{{XL_NS_MAIN}}}c"
+_TAG_VALUE = f"{{{XL_NS_MAIN}}}v"
+_TAG_INLINE_STR = f"{{{XL_NS_MAIN}}}is"
+_TAG_TEXT = f"{{{XL_NS_MAIN}}}t"
+_TAG_RUN = f"{{{XL_NS_MAIN}}}r"
+_TAG_SHARED_ITEM = f"{{{XL_NS_MAIN}}}si"
+
+# Code points XML 1.0 cannot carry (C0 controls except \t \n \r, lone surrogates) → dropped via str.translate
+_XML_DROP_TABLE = dict.fromkeys([*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20), *range(0xD800, 0xE000)])
+
+# Same drop set plus the escapes element text needs: one translate() pass yields text that can be
+# written between <t>…</t> verbatim
+_XML_TEXT_TABLE = {**_XML_DROP_TABLE, ord("&"): "&amp;", ord("<"): "&lt;", ord(">"): "&gt;"}
+
+_NORM_LOCALE_SUFFIX = re.compile(r"\s*-\s*en\s*[-_ ]\s*us\s*$")
+_NORM_DASHES = str.maketrans({"–": "-", "—": "-", "−": "-"})
+_NORM_SEPARATORS = re.compile(r"[._/\\-]+")
+_NORM_NON_ALNUM = re.compile(r"[^0-9a-z\s]+")
+_NORM_SPACES = re.compile(r"\s+")
+
+def norm(s) -> str:
+    # str() first so any mapping value (numbers, lists) normalizes as before and the cache key is hashable
     if s is None: return ""
-    return _INVALID_XML_CHARS.sub("", str(s))
-
-def norm(s: str) -> str:
-    if s is None: return ""
-    x = str(s).strip().lower()
-    x = re.sub(r"\s*-\s*en\s*[-_ ]\s*us\s*$", "", x)
-    x = x.replace("–","-").replace("—","-").replace("−","-")
-    x = re.sub(r"[._/\\-]+", " ", x)
-    x = re.sub(r"[^0-9a-z\s]+", " ", x)
-    return re.sub(r"\s+", " ", x).strip()
-
-def top_matches(query, candidates, k=3):
+    return _norm_str(s if type(s) is str else str(s))
+
+@functools.lru_cache(maxsize=4096)   # the same headers/aliases are normalized over and over
+def _norm_str(s: str) -> str:
+    x = s.strip().lower()
+    x = _NORM_LOCALE_SUFFIX.sub("", x)
+    x = x.translate(_NORM_DASHES)
+    x = _NORM_SEPARATORS.sub(" ", x)
+    x = _NORM_NON_ALNUM.sub(" ", x)
+    return _NORM_SPACES.sub(" ", x).strip()
+
+def top_matches(query, candidates, k=3, candidates_norm=None):
+    # candidates_norm: norm() of each candidate, precomputed by callers that score many queries
+    if candidates_norm is None:
+        candidates_norm = [norm(c) for c in candidates]
     q = norm(query)
-    scored = [(SequenceMatcher(None, q, norm(c)).ratio(), c) for c in candidates]
+    if process is not None:
+        hits = process.extract(q, candidates_norm, scorer=fuzz.ratio, processor=None, limit=k)
+        return [(score / 100.0, candidates[i]) for _, score, i in hits]
+    scored = [(SequenceMatcher(None, q, cn).ratio(), c) for c, cn in zip(candidates, candidates_norm)]
     scored.sort(key=lambda t: t[0], reverse=True)
     return scored[:k]
 
@@ -73,25 +136,50 @@ def nonempty_rows(df: pd.DataFrame) -> int:
     if df.empty: return 0
     return df.replace("", pd.NA).dropna(how="all").shape[0]
 
-def worksheet_used_cols(ws, header_rows=(1,), hard_cap=2048, empty_streak_stop=8):
-    max_try = min(ws.max_column, hard_cap)
+def clean_column_values(src: pd.Series, n_rows: int) -> np.ndarray:
+    # Vectorized per column: strip + XML-sanitize + escape; NaN and literal 'nan'/'none' become ""
+    vals = src.to_numpy(dtype=object, na_value="")[:n_rows]
+    if _ARROW_STR is not None:
+        try:
+            # strip/lower/isin run as Arrow kernels; lone surrogates can't be Arrow strings → object path
+            s = pd.Series(vals, dtype=_ARROW_STR).str.strip().str.translate(_XML_TEXT_TABLE)
+            empty = s.str.lower().isin(("nan", "none")).to_numpy(dtype=bool)
+            return np.where(empty, "", s.to_numpy(dtype=object, na_value=""))
+        except (UnicodeError, ValueError, TypeError):
+            pass
+    s = pd.Series([v if type(v) is str else str(v) for v in vals], dtype=object)   # str() like the Arrow cast
+    s = s.str.strip().str.translate(_XML_TEXT_TABLE)
+    return np.where(s.str.lower().isin(("nan", "none")), "", s.to_numpy(dtype=object))
+
+def rows_used_cols(rows, max_try, empty_streak_stop=8):
+    # Last column with a value in any of the given row tuples; stops after a run of empty columns
     last_nonempty, streak = 0, 0
     for c in range(1, max_try + 1):
-        any_val = any((ws.cell(row=r, column=c).value not in (None, "")) for r in header_rows)
+        any_val = any(c <= len(row) and row[c-1] not in (None, "") for row in rows)
         if any_val: last_nonempty, streak = c, 0
         else:
             streak += 1
             if streak >= empty_streak_stop: break
     return max(last_nonempty, 1)
 
-def _col_letter(n: int) -> str:
+def _col_letter_calc(n: int) -> str:
     s = ""
     while n:
         n, r = divmod(n-1, 26)
         s = chr(65+r) + s
     return s
 
+# Excel's column cap is XFD (16384): precompute every A1 column name (and its reverse map) once
+_COL_LETTERS = [_col_letter_calc(i) for i in range(16385)]   # index 0 → ""
+_COL_NUMBERS = {letters: i for i, letters in enumerate(_COL_LETTERS) if i}
+
+def _col_letter(n: int) -> str:
+    return _COL_LETTERS[n] if 0 <= n <= 16384 else _col_letter_calc(n)
+
 def _col_number(letters: str) -> int:
+    n = _COL_NUMBERS.get(letters)
+    if n is not None:
+        return n
     n = 0
     for ch in letters:
         if not ch.isalpha(): break
@@ -107,19 +195,48 @@ def safe_filename(name: str, fallback: str = "final_masterfile") -> str:
     return name or fallback
 
 # ── ZIP / XML helpers ────────────────────────────────────────────────
-def _find_sheet_part_path(z: zipfile.ZipFile, sheet_name: str) -> str:
-    wb_xml = ET.fromstring(z.read("xl/workbook.xml"))
-    rels_xml = ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+# One parser per thread: an lxml parser is locked while in use, so a shared one would serialize
+# the sheet/table/workbook parses that fast_patch_template runs on its pool
+_LXML_PARSERS = threading.local()
+
+def _xml_fromstring(data: bytes):
+    if LET is None: return ET.fromstring(data)
+    parser = getattr(_LXML_PARSERS, "parser", None)
+    if parser is None:
+        parser = _LXML_PARSERS.parser = LET.XMLParser(huge_tree=True, remove_blank_text=False)
+    return LET.fromstring(data, parser=parser)
+
+# Every part we write gets the same declaration Excel emits: prepend it as bytes instead of
+# going through the serializer's declaration formatting
+_XML_DECL = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+def _xml_tostring(root) -> bytes:
+    if LET is not None:
+        return _XML_DECL + LET.tostring(root, encoding="UTF-8")
+    return _XML_DECL + ET.tostring(root, encoding="utf-8")
+
+def _xml_iterparse(data: bytes, events=("start",)):
+    # Streaming scan for lookups that only need a few attributes: callers break out early, no tree kept
+    src = io.BytesIO(data)
+    if LET is not None:
+        return LET.iterparse(src, events=events, huge_tree=True)
+    return ET.iterparse(src, events=events)
+
+def _zip_name_index(z: zipfile.ZipFile) -> dict:
+    # filename -> ZipInfo, built once per archive; read(ZipInfo) skips the name lookup
+    return {zi.filename: zi for zi in z.infolist()}
+
+def _find_sheet_part_path(z: zipfile.ZipFile, name_index: dict, sheet_name: str) -> str:
     rid = None
-    for sh in wb_xml.find(f"{{{XL_NS_MAIN}}}sheets"):
-        if sh.attrib.get("name") == sheet_name:
-            rid = sh.attrib.get(f"{{{XL_NS_REL}}}id")
+    for _, el in _xml_iterparse(z.read(name_index["xl/workbook.xml"])):
+        if el.tag == _TAG_SHEET and el.get("name") == sheet_name:
+            rid = el.get(f"{{{XL_NS_REL}}}id")
             break
     if not rid: raise ValueError(f"Sheet '{sheet_name}' not found.")
     target = None
-    for rel in rels_xml:
-        if rel.attrib.get("Id") == rid:
-            target = rel.attrib.get("Target")
+    for _, el in _xml_iterparse(z.read(name_index["xl/_rels/workbook.xml.rels"])):
+        if el.get("Id") == rid:
+            target = el.get("Target")
             break
     if not target: raise ValueError(f"Relationship for sheet '{sheet_name}' not found.")
     target = target.replace("\\", "/")
@@ -127,10 +244,11 @@ def _find_sheet_part_path(z: zipfile.ZipFile, sheet_name: str) -> str:
     if not target.startswith("xl/"): target = "xl/" + target
     return target  # e.g., xl/worksheets/sheet1.xml
 
-def _get_table_paths_for_sheet(z: zipfile.ZipFile, sheet_path: str) -> list:
+def _get_table_paths_for_sheet(z: zipfile.ZipFile, name_index: dict, sheet_path: str) -> list:
     rels_path = sheet_path.replace("worksheets/", "worksheets/_rels/").replace(".xml", ".xml.rels")
-    if rels_path not in z.namelist(): return []
-    root = ET.fromstring(z.read(rels_path))
+    rels_info = name_index.get(rels_path)
+    if rels_info is None: return []
+    root = _xml_fromstring(z.read(rels_info))
     out = []
     for rel in root:
         t = rel.attrib.get("Type", "")
@@ -141,21 +259,102 @@ def _get_table_paths_for_sheet(z: zipfile.ZipFile, sheet_path: str) -> list:
             out.append(target)
     return out
 
+def _find_shared_strings_path(z: zipfile.ZipFile, name_index: dict):
+    for _, el in _xml_iterparse(z.read(name_index["xl/_rels/workbook.xml.rels"])):
+        if el.get("Type", "").endswith("/sharedStrings"):
+            target = el.get("Target", "").replace("\\", "/")
+            if target.startswith("/"): target = target[1:]
+            if target.startswith("../"): target = target[3:]
+            if not target.startswith("xl/"): target = "xl/" + target
+            return target
+    return None
+
+def _string_item_text(el) -> str:
+    # <si>/<is>: plain <t>, or the <t> of each rich-text run (phonetic <rPh> runs are skipped)
+    parts = []
+    for child in el:
+        if child.tag == _TAG_TEXT:
+            parts.append(child.text or "")
+        elif child.tag == _TAG_RUN:
+            t = child.find(_TAG_TEXT)
+            if t is not None: parts.append(t.text or "")
+    return "".join(parts)
+
+def _read_shared_strings(z: zipfile.ZipFile, name_index: dict, wanted: set) -> dict:
+    """{index: text} for the wanted sharedStrings items only; streaming stops after the highest one."""
+    path = _find_shared_strings_path(z, name_index) if wanted else None
+    if path is None or path not in name_index: return {}
+    out, idx, last = {}, 0, max(wanted)
+    for _, el in _xml_iterparse(z.read(name_index[path]), ("end",)):
+        if el.tag != _TAG_SHARED_ITEM: continue
+        if idx in wanted: out[idx] = _string_item_text(el)
+        if idx >= last: break
+        idx += 1
+        el.clear()
+    return out
+
+def _cell_xml_value(t: str, text):
+    # Typed value of a non-shared cell, following openpyxl's casts (int unless '.'/exponent, bool for t="b")
+    if text is None: return None
+    if t in ("str", "inlineStr", "e"): return text
+    if t == "b": return text == "1"
+    try:
+        return float(text) if ("." in text or "E" in text or "e" in text) else int(text)
+    except ValueError:
+        return text
+
+def _read_sheet_row_values(z: zipfile.ZipFile, name_index: dict, sheet_path: str, row_numbers, max_col: int) -> dict:
+    """{row number: tuple of cell values} for a few rows, streamed from the sheet XML (no workbook load).
+    Stops at the first row past the last wanted one; shared strings are resolved for those rows only."""
+    wanted_rows, last_row = set(row_numbers), max(row_numbers)
+    raw, cur, r, col = {}, None, 0, 0
+    for ev, el in _xml_iterparse(z.read(name_index[sheet_path]), ("start", "end")):
+        if el.tag == _TAG_ROW:
+            if ev == "start":
+                r = int(el.get("r") or r + 1); col = 0
+                if r > last_row: break
+                cur = raw.setdefault(r, {}) if r in wanted_rows else None
+            else:
+                el.clear()
+        elif el.tag == _TAG_CELL and ev == "end":
+            ref = el.get("r")
+            col = _col_number(ref) if ref else col + 1
+            if cur is None or col > max_col: continue
+            t = el.get("t", "n")
+            if t == "inlineStr":
+                is_el = el.find(_TAG_INLINE_STR)
+                cur[col] = (t, _string_item_text(is_el) if is_el is not None else None)
+            else:
+                v = el.find(_TAG_VALUE)
+                cur[col] = (t, v.text if v is not None else None)
+    wanted_ss = {int(text) for cells in raw.values() for t, text in cells.values() if t == "s" and text is not None}
+    shared = _read_shared_strings(z, name_index, wanted_ss)
+    out = {}
+    for rn, cells in raw.items():
+        vals = [None] * max(cells, default=0)
+        for c, (t, text) in cells.items():
+            vals[c - 1] = shared.get(int(text)) if t == "s" and text is not None else _cell_xml_value(t, text)
+        out[rn] = tuple(vals)
+    return out
+
 def _read_table_cols_count(table_xml_bytes: bytes) -> int:
+    # Stream up to </tableColumns>: larger of its 'count' and the number of <tableColumn> children
     try:
-        root = ET.fromstring(table_xml_bytes)
-        tcols = root.find(f"{{{XL_NS_MAIN}}}tableColumns")
-        if tcols is None: return 0
-        cnt_attr = tcols.attrib.get("count")
-        cnt = int(cnt_attr) if cnt_attr else 0
-        child_count = sum(1 for _ in tcols)
-        return max(cnt, child_count)
+        cnt = child_count = 0
+        for ev, el in _xml_iterparse(table_xml_bytes, ("start", "end")):
+            if el.tag == _TAG_TABLE_COLUMN:
+                if ev == "start": child_count += 1
+            elif el.tag == _TAG_TABLE_COLUMNS:
+                if ev == "end": return max(cnt, child_count)
+                cnt_attr = el.get("count")
+                cnt = int(cnt_attr) if cnt_attr else 0
+        return 0
     except Exception:
         return 0
 
 def _union_dimension(orig_dim_ref: str, used_cols: int, last_row: int) -> str:
     try:
-        _, right = orig_dim_ref.split(":", 1)
+        left, right = orig_dim_ref.split(":", 1)
         m = re.match(r"([A-Z]+)(\d+)", right)
         if m:
             orig_last_col = _col_number(m.group(1))
@@ -163,7 +362,9 @@ def _union_dimension(orig_dim_ref: str, used_cols: int, last_row: int) -> str:
         else:
             orig_last_col, orig_last_row = used_cols, last_row
     except Exception:
-        orig_last_col, orig_last_row = used_cols, last_row
+        left, orig_last_col, orig_last_row = "", used_cols, last_row
+    if left == "A1" and orig_last_col >= used_cols and orig_last_row >= last_row:
+        return orig_dim_ref   # already covers the data: no rebuild
     u_last_col = max(orig_last_col, used_cols)
     u_last_row = max(orig_last_row, last_row)
     return f"A1:{_col_letter(u_last_col)}{u_last_row}"
@@ -181,148 +382,424 @@ def _intersects_range(a1: str, r1: int, r2: int) -> bool:
     if lo > hi: lo, hi = hi, lo
     return not (hi < r1 or lo > r2)
 
-def _patch_sheet_xml(sheet_xml_bytes: bytes, header_row: int, start_row: int, used_cols_final: int, block_2d: list) -> bytes:
-    root = ET.fromstring(sheet_xml_bytes)
+_SHEETDATA_OPEN_RE = re.compile(rb"<((?:\w+:)?)sheetData\b[^>]*?(/?)>")
+_ROOT_START_TAG_RE = re.compile(rb"<(?![?!])[^>]*>")
+_ROW_BATCH = 1000   # block rows converted/emitted per batch in _patch_sheet_xml
+_ROW_START_TAG_RE = re.compile(rb"<(?:\w+:)?row\b[^>]*>")
+_ROW_NUMBER_ATTR_RE = re.compile(rb"""\sr\s*=\s*["'](\d+)["']""")
+
+def _cut_data_rows(xml: bytes, start_row: int) -> bytes:
+    """Sheet XML without its <row>s numbered >= start_row, cut out as one byte span (nothing parsed).
+    Rows are stored in ascending order, so the span runs from the first such row to </sheetData>;
+    only row start tags up to that point are scanned."""
+    m = _SHEETDATA_OPEN_RE.search(xml)
+    if m is None or m.group(2): return xml
+    close = xml.find(b"</%ssheetData>" % m.group(1), m.end())
+    if close < 0: return xml
+    r = 0
+    for rm in _ROW_START_TAG_RE.finditer(xml, m.end(), close):
+        num = _ROW_NUMBER_ATTR_RE.search(rm.group(0))
+        r = int(num.group(1)) if num else r + 1   # a row without r follows the previous one
+        if r >= start_row:
+            return xml[:rm.start()] + xml[close:]
+    return xml
+
+def _ensure_root_ns_decl(xml: bytes, prefix: str, uri: str) -> bytes:
+    # The serializer only declares namespaces it used itself; text spliced in afterwards may need more
+    m = _ROOT_START_TAG_RE.search(xml)
+    if m is None or b"xmlns:%s=" % prefix.encode() in m.group(0): return xml
+    decl = b' xmlns:%s="%s"' % (prefix.encode(), uri.encode())
+    return xml[:m.end() - 1] + decl + xml[m.end() - 1:]
+
+def _patch_sheet_xml(sheet_xml_bytes: bytes, header_row: int, start_row: int, used_cols_final: int, block_2d):
+    """Patched sheet XML as an iterator of byte chunks (prolog, row batches, epilog) in document order.
+    The chunks are deflated as they are produced, so the full document is never concatenated."""
+    # 1) Existing data rows are cut out of the bytes before parsing: the tree below only ever holds
+    #    the prolog, the kept header rows and the epilog, however many rows the template ships with
+    root = _xml_fromstring(_cut_data_rows(sheet_xml_bytes, start_row))
     _ensure_ws_x14ac(root)
 
-    sheetData = root.find(f"{{{XL_NS_MAIN}}}sheetData")
+    sheetData = root.find(_TAG_SHEET_DATA)
     if sheetData is None:
-        sheetData = ET.SubElement(root, f"{{{XL_NS_MAIN}}}sheetData")
+        sheetData = root.makeelement(_TAG_SHEET_DATA, {})   # lxml and ET roots alike
+        root.append(sheetData)
 
-    # 1) Remove existing data rows at/after start_row
-    for row in list(sheetData):
+    #    Out-of-order rows the byte cut could not see are dropped here (only kept rows remain to check)
+    keep = []
+    for row in sheetData:
         try:
             r = int(row.attrib.get("r") or "0")
         except Exception:
             r = 0
-        if r >= start_row:
-            sheetData.remove(row)
+        if r < start_row:
+            keep.append(row)
+    if len(keep) != len(sheetData):
+        sheetData[:] = keep
 
     # 2) Remove mergeCells that intersect our data region to prevent "Repaired Records"
-    mergeCells = root.find(f"{{{XL_NS_MAIN}}}mergeCells")
+    mergeCells = root.find(_TAG_MERGE_CELLS)
     if mergeCells is not None:
         for mc in list(mergeCells):
             ref = mc.attrib.get("ref", "")
             if _intersects_range(ref, start_row, 1048576):
                 mergeCells.remove(mc)
-        if len(list(mergeCells)) == 0:
+        if len(mergeCells) == 0:
             root.remove(mergeCells)
 
-    # 3) Append dense rows (A..lastCol) using inlineStr (keeps rows visible, no sparse-row repair)
-    row_span = f"1:{used_cols_final}" if used_cols_final > 0 else "1:1"
+    # 3) New rows use inlineStr cells for every column that has data in any row (columns empty
+    #    throughout the block are left out); they are formatted straight to text and spliced
+    #    into <sheetData> after serialization (step 7)
     n_rows = len(block_2d)
-    for i in range(n_rows):
-        r = start_row + i
-        src_row = block_2d[i]
-        row_el = ET.Element(f"{{{XL_NS_MAIN}}}row", r=str(r))
-        row_el.set("spans", row_span)
-        row_el.set("{http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac}dyDescent", "0.25")
-
-        for j in range(used_cols_final):
-            val = src_row[j] if j < len(src_row) else ""
-            txt = sanitize_xml_text(val) if val else ""
-            col = _col_letter(j + 1)
-            c = ET.Element(f"{{{XL_NS_MAIN}}}c", r=f"{col}{r}", t="inlineStr")
-            is_el = ET.SubElement(c, f"{{{XL_NS_MAIN}}}is")
-            t_el = ET.SubElement(is_el, f"{{{XL_NS_MAIN}}}t")
-            t_el.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
-            t_el.text = txt  # empty allowed → row still visible
-            row_el.append(c)
-
-        sheetData.append(row_el)
 
     # 4) Dimension: conservative union with original
-    dim = root.find(f"{{{XL_NS_MAIN}}}dimension")
+    dim = root.find(_TAG_DIMENSION)
     if dim is None:
-        dim = ET.SubElement(root, f"{{{XL_NS_MAIN}}}dimension", ref="A1:A1")
+        dim = root.makeelement(_TAG_DIMENSION, {"ref": "A1:A1"})
+        root.append(dim)
     last_row = max(header_row, start_row + max(0, n_rows) - 1)
-    new_ref = _union_dimension(dim.attrib.get("ref", "A1:A1"), used_cols_final, last_row)
-    dim.set("ref", new_ref)
+    old_ref = dim.attrib.get("ref", "A1:A1")
+    new_ref = _union_dimension(old_ref, used_cols_final, last_row)
+    if new_ref != old_ref:
+        dim.set("ref", new_ref)
 
     # 5) AutoFilter: only update if one existed originally
-    af = root.find(f"{{{XL_NS_MAIN}}}autoFilter")
+    af = root.find(_TAG_AUTO_FILTER)
     if af is not None:
         af.set("ref", f"A{header_row}:{_col_letter(used_cols_final)}{last_row}")
 
     # 6) Clear filterMode flag if present (prevents repair on changed rows)
-    sheetPr = root.find(f"{{{XL_NS_MAIN}}}sheetPr")
+    sheetPr = root.find(_TAG_SHEET_PR)
     if sheetPr is not None and sheetPr.attrib.get("filterMode"):
         sheetPr.attrib.pop("filterMode", None)
 
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+    xml = _ensure_root_ns_decl(_xml_tostring(root), "x14ac", XL_NS_X14AC)
+
+    # 7) Emit the data rows as text (no Element per cell) using the prefix the serializer gave <sheetData>.
+    #    block_2d must already be XML-sanitized and escaped (clean_column_values does both per column).
+    m = _SHEETDATA_OPEN_RE.search(xml)
+    p = m.group(1).decode()
+    rows = _iter_sheet_rows(block_2d, start_row, used_cols_final, p)
+
+    xml_view = memoryview(xml)   # slices below are views, not copies
+    if m.group(2):  # <sheetData/>: nothing kept above start_row
+        open_tag = xml[m.start():m.end() - 2].rstrip() + b">"
+        return itertools.chain((xml_view[:m.start()], open_tag), rows, (b"</%ssheetData>" % m.group(1), xml_view[m.end():]))
+    close = xml.index(b"</%ssheetData>" % m.group(1), m.end())
+    return itertools.chain((xml_view[:close],), rows, (xml_view[close:],))
+
+def _iter_sheet_rows(block_2d, start_row: int, used_cols_final: int, p: str):
+    # Yields the new <row> elements as one bytes chunk per _ROW_BATCH rows, so the compressor
+    # consumes them as they are produced and the full rows payload never sits in memory
+    row_span = f"1:{used_cols_final}" if used_cols_final > 0 else "1:1"
+    # Markup is the same on every row: pre-encode each cell's '<c r="AB' head and the fixed
+    # tag runs once, then append bytes into the batch buffer (no per-cell str formatting)
+    # Columns that are empty in every row get no cells at all (less XML to build and deflate)
+    if isinstance(block_2d, np.ndarray) and block_2d.ndim == 2:
+        cols = np.flatnonzero((block_2d[:, :used_cols_final] != "").any(axis=0)).tolist()
+    else:
+        cols = range(used_cols_final)
+    cell_heads = [(j, f'<{p}c r="{_col_letter(j + 1)}'.encode()) for j in cols]
+    cell_mid = f'" t="inlineStr"><{p}is><{p}t xml:space="preserve">'.encode()
+    cell_tail = f'</{p}t></{p}is></{p}c>'.encode()
+    row_head = f'<{p}row r="'.encode()
+    row_mid = f'" spans="{row_span}" x14ac:dyDescent="0.25">'.encode()
+    row_tail = f'</{p}row>'.encode()
+    # block_2d may be a 2-D object ndarray: convert it to lists one batch at a time, so element
+    # access stays on plain Python lists without materializing a full copy of the block
+    for b0 in range(0, len(block_2d), _ROW_BATCH):
+        batch = block_2d[b0:b0 + _ROW_BATCH]
+        if isinstance(batch, np.ndarray):
+            batch = batch.tolist()
+        rows_xml = bytearray()
+        for i, src_row in enumerate(batch, start_row + b0):
+            rb = b"%d" % i
+            n_src = len(src_row)
+            rows_xml += row_head; rows_xml += rb; rows_xml += row_mid
+            for j, head in cell_heads:
+                rows_xml += head; rows_xml += rb; rows_xml += cell_mid
+                val = src_row[j] if j < n_src else ""
+                if val:
+                    rows_xml += str(val).encode("utf-8")
+                rows_xml += cell_tail
+            rows_xml += row_tail
+        yield rows_xml
 
 def _patch_table_xml(table_xml_bytes: bytes, header_row: int, last_row: int, last_col_n: int) -> bytes:
-    root = ET.fromstring(table_xml_bytes)
+    root = _xml_fromstring(table_xml_bytes)
     new_ref = f"A{header_row}:{_col_letter(last_col_n)}{last_row}"
-    root.set("ref", new_ref)
+    changed = False
+    if root.get("ref") != new_ref:
+        root.set("ref", new_ref)
+        changed = True
 
-    af = root.find(f"{{{XL_NS_MAIN}}}autoFilter")
+    af = root.find(_TAG_AUTO_FILTER)
     if af is None:
-        af = ET.SubElement(root, f"{{{XL_NS_MAIN}}}autoFilter")
-    af.set("ref", new_ref)
+        af = root.makeelement(_TAG_AUTO_FILTER, {})   # works for both lxml and ET roots
+        root.append(af)
+    if af.get("ref") != new_ref:
+        af.set("ref", new_ref)
+        changed = True
 
     # Keep tableColumns list as-is; just ensure the 'count' equals the number of children (Excel requirement)
-    tcols = root.find(f"{{{XL_NS_MAIN}}}tableColumns")
+    tcols = root.find(_TAG_TABLE_COLUMNS)
     if tcols is not None:
-        child_count = sum(1 for _ in tcols)
-        tcols.set("count", str(child_count))
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+        child_count = str(len(tcols.findall(_TAG_TABLE_COLUMN)))
+        if tcols.get("count") != child_count:
+            tcols.set("count", child_count)
+            changed = True
+    # Table already matches the new data block: keep the original bytes (no re-serialization)
+    return _xml_tostring(root) if changed else table_xml_bytes
 
 def _strip_calcchain_override(ct_bytes: bytes) -> bytes:
+    # Most templates have no calcChain: skip the parse/serialize round trip and copy the part as-is
+    if b"calcchain" not in ct_bytes.lower():
+        return ct_bytes
     try:
         ns = "http://schemas.openxmlformats.org/package/2006/content-types"
-        root = ET.fromstring(ct_bytes)
-        ET.register_namespace("", ns)
+        root = _xml_fromstring(ct_bytes)
+        if LET is None: ET.register_namespace("", ns)
+        override_tag = f"{{{ns}}}Override"
         for el in list(root):
-            if el.tag == f"{{{ns}}}Override" and el.attrib.get("PartName","").lower() == "/xl/calcchain.xml":
+            if el.tag == override_tag and el.attrib.get("PartName","").lower() == "/xl/calcchain.xml":
                 root.remove(el)
-        return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+        return _xml_tostring(root)
     except Exception:
         return ct_bytes
 
-def fast_patch_template(master_bytes: bytes, sheet_name: str, header_row: int, start_row: int, used_cols: int, block_2d: list) -> bytes:
-    """Ultra-fast writer: swaps only the target sheet XML + syncs tables & filters; removes calcChain."""
+# Output is downloaded once and discarded: favour deflate speed over ratio.
+# Used for the parts we compress ourselves and for the writestr() fallbacks (copied ZipInfo carries no level).
+ZIP_COMPRESSLEVEL = 1
+
+_ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")   # fixed 30-byte part of a local file header
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    # FileHeader() re-adds a zip64 record when needed; drop the source's copy to avoid duplicates
+    out, i = [], 0
+    while i + 4 <= len(extra):
+        tp, ln = struct.unpack_from("<HH", extra, i)
+        if tp != 0x0001: out.append(extra[i:i + 4 + ln])
+        i += 4 + ln
+    return b"".join(out)
+
+def _copy_zip_member_raw(zin: zipfile.ZipFile, zout: zipfile.ZipFile, item: zipfile.ZipInfo) -> None:
+    """Copy a member's compressed bytes as-is (no inflate/deflate round trip)."""
+    # Encrypted / zip64-sized members take the regular path
+    if item.flag_bits & 0x01 or max(item.file_size, item.compress_size) >= zipfile.ZIP64_LIMIT:
+        zout.writestr(item, zin.read(item), compresslevel=ZIP_COMPRESSLEVEL)
+        return
+    zin.fp.seek(item.header_offset)
+    name_len, extra_len = _ZIP_LOCAL_HEADER.unpack(zin.fp.read(_ZIP_LOCAL_HEADER.size))[-2:]
+    data_offset = item.header_offset + _ZIP_LOCAL_HEADER.size + name_len + extra_len
+
+    zi = copy.copy(item)
+    # Streamed members (bit 3) keep CRC/sizes in a trailing data descriptor; the central directory
+    # already gave us the real values, so write them in the local header and leave the descriptor behind
+    zi.flag_bits &= ~0x08
+    zi.extra = _strip_zip64_extra(item.extra)
+    _append_zip_member(zout, zi, _iter_raw_payload(zin.fp, data_offset, item.compress_size))
+
+_RAW_COPY_CHUNK = 1 << 20
+
+def _iter_raw_payload(fp, offset: int, size: int):
+    # A member's compressed bytes in 1 MB slices: big images / vbaProject.bin are never read whole
+    fp.seek(offset)
+    while size > 0:
+        chunk = fp.read(min(size, _RAW_COPY_CHUNK))
+        if not chunk: raise zipfile.BadZipFile("Truncated member data")
+        size -= len(chunk)
+        yield chunk
+
+def _append_zip_member(zout: zipfile.ZipFile, zi: zipfile.ZipInfo, raw) -> None:
+    # Local header + already-compressed payload (bytes or an iterable of chunks) at the end of the
+    # archive; the central directory is written from zout.filelist on close
+    zout.fp.seek(zout.start_dir)
+    zi.header_offset = zout.fp.tell()
+    zout.fp.write(zi.FileHeader())
+    if isinstance(raw, (bytes, bytearray)):
+        zout.fp.write(raw)
+    else:
+        for chunk in raw:
+            zout.fp.write(chunk)
+    zout.start_dir = zout.fp.tell()
+    zout.filelist.append(zi)
+    zout.NameToInfo[zi.filename] = zi
+
+def _deflate_member(item: zipfile.ZipInfo, data) -> tuple:
+    """(ZipInfo, raw deflate bytes) for data at ZIP_COMPRESSLEVEL (ISA-L when installed, else zlib).
+    data is bytes or an iterable of byte chunks (streamed through the compressor; CRC/size kept running).
+    Touches no ZipFile, so it can run on worker threads; _append_zip_member writes the result."""
+    chunks = (data,) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    co = _deflate_lib.compressobj(ZIP_COMPRESSLEVEL, _deflate_lib.DEFLATED, -15)   # raw deflate stream
+    out, crc, size = bytearray(), 0, 0
+    for chunk in chunks:
+        out += co.compress(chunk)
+        crc = _deflate_lib.crc32(chunk, crc)
+        size += len(chunk)
+    out += co.flush()
+    zi = copy.copy(item)
+    zi.compress_type = zipfile.ZIP_DEFLATED
+    zi.flag_bits = item.flag_bits & 0x800   # keep only the UTF-8 name flag: sizes/CRC go in the header
+    zi.CRC = crc
+    zi.file_size = size
+    zi.compress_size = len(out)
+    zi.extra = _strip_zip64_extra(item.extra)   # FileHeader() adds a zip64 record itself if needed
+    return zi, out
+
+def _patched_member(item: zipfile.ZipInfo, patch, data: bytes, *args):
+    # Patch + deflate one part (pool task); None when the patch returned its input untouched
+    patched = patch(data, *args)
+    return None if patched is data else _deflate_member(item, patched)
+
+_CALCPR_RE = re.compile(rb"<((?:\w+:)?)calcPr\b([^>]*?)(/?)>")
+_CALCPR_ANCHOR_RE = re.compile(rb"<(/?)((?:\w+:)?)(?:definedNames|externalReferences|functionGroups|sheets)\b[^>]*?(/?)>")
+
+def _set_full_calc_on_load(wb_xml_bytes: bytes) -> bytes:
+    # Byte-level edit of <calcPr> so mc:Ignorable prefixes in workbook.xml survive untouched
+    m = _CALCPR_RE.search(wb_xml_bytes)
+    if m:
+        attrs = re.sub(rb'\s+fullCalcOnLoad="[^"]*"', b"", m.group(2))
+        tag = b'<%scalcPr%s fullCalcOnLoad="1"%s>' % (m.group(1), attrs, m.group(3))
+        return wb_xml_bytes[:m.start()] + tag + wb_xml_bytes[m.end():]
+    # No calcPr yet: schema order puts it after the last of sheets, functionGroups, externalReferences, definedNames
+    # (closing or self-closing tag; functionGroups is often written as <functionGroups .../>)
+    anchors = [m for m in _CALCPR_ANCHOR_RE.finditer(wb_xml_bytes) if m.group(1) or m.group(3)]
+    if not anchors: return wb_xml_bytes
+    m = anchors[-1]
+    tag = b'<%scalcPr fullCalcOnLoad="1"/>' % m.group(2)
+    return wb_xml_bytes[:m.end()] + tag + wb_xml_bytes[m.end():]
+
+def fast_patch_template(master_bytes: bytes, sheet_name: str, header_row: int, start_row: int, used_cols: int, block_2d,
+                        full_calc_on_load: bool = False) -> io.BytesIO:
+    """Ultra-fast writer: swaps only the target sheet XML + syncs tables & filters; removes calcChain.
+    full_calc_on_load=True also flags workbook.xml so Excel recalculates all formulas when opened.
+    block_2d is a list of row lists or a 2-D object ndarray of already sanitized, XML-escaped strings.
+    Returns the output buffer rewound to 0 (hand it straight to st.download_button, no extra copy)."""
     zin = zipfile.ZipFile(io.BytesIO(master_bytes), "r")
-    sheet_path = _find_sheet_part_path(zin, sheet_name)
-    table_paths = _get_table_paths_for_sheet(zin, sheet_path)
+    name_index = _zip_name_index(zin)
+    sheet_path = _find_sheet_part_path(zin, name_index, sheet_name)
+    table_paths = _get_table_paths_for_sheet(zin, name_index, sheet_path)
 
-    # Use at least the widest table width (some tables define more columns than headers)
-    max_cols = used_cols
+    # Read each table part once (width probe + patch both need it); no tables → no table work
+    table_xml = {}
     for tp in table_paths:
-        try:
-            cnt = _read_table_cols_count(zin.read(tp))
-            if cnt > max_cols: max_cols = cnt
-        except Exception:
-            pass
+        if tp in name_index:
+            table_xml[tp] = zin.read(name_index[tp])
 
-    new_sheet_xml = _patch_sheet_xml(zin.read(sheet_path), header_row, start_row, max_cols, block_2d)
+    # Use at least the widest table width (some tables define more columns than headers)
+    max_cols = used_cols
+    for xml in table_xml.values():
+        cnt = _read_table_cols_count(xml)
+        if cnt > max_cols: max_cols = cnt
 
     last_row = max(header_row, start_row + max(0, len(block_2d)) - 1)
-    patched_tables = {}
-    for tp in table_paths:
+    infos = zin.infolist()
+    ct_item = next((zi for zi in infos if zi.filename.lower() == "[content_types].xml"), None)
+    wb_item = name_index.get("xl/workbook.xml") if full_calc_on_load else None
+
+    # Every rewritten part (sheet, tables, content types, workbook) is patched *and* deflated on one
+    # pool: the parts are independent and lxml/zlib/ISA-L release the GIL. Inputs are read up front
+    # so workers never touch zin.
+    sheet_info = name_index[sheet_path]
+    n_jobs = 1 + len(table_xml) + (ct_item is not None) + (wb_item is not None)
+    with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, os.cpu_count() or 1))) as ex:
+        sheet_fut = ex.submit(_patched_member, sheet_info, _patch_sheet_xml, zin.read(sheet_info),
+                              header_row, start_row, max_cols, block_2d)
+        futures = {tp: ex.submit(_patched_member, name_index[tp], _patch_table_xml, xml, header_row, last_row, max_cols)
+                   for tp, xml in table_xml.items()}
+        if ct_item is not None:
+            futures[ct_item.filename] = ex.submit(_patched_member, ct_item, _strip_calcchain_override, zin.read(ct_item))
+        if wb_item is not None:
+            futures[wb_item.filename] = ex.submit(_patched_member, wb_item, _set_full_calc_on_load, zin.read(wb_item))
+    rewritten = {sheet_path: sheet_fut.result()}   # the sheet patch failing fails the export
+    for fn, fut in futures.items():
         try:
-            patched_tables[tp] = _patch_table_xml(zin.read(tp), header_row, last_row, max_cols)
+            rewritten[fn] = fut.result()
         except Exception:
-            pass
+            pass   # a part we could not patch (e.g. malformed table) keeps its original bytes
 
+    # Pre-size the buffer to the output (raw-copied parts + our deflated parts) so writes fill it
+    # in place instead of repeatedly reallocating; trimmed after close
+    est_size = sum(len(m[1]) if m is not None else zi.compress_size
+                   for zi in infos for m in (rewritten.get(zi.filename),))
     out_bio = io.BytesIO()
-    with zipfile.ZipFile(out_bio, "w", zipfile.ZIP_DEFLATED) as zout:
-        for item in zin.infolist():
-            fn = item.filename
-            if fn == sheet_path:
-                zout.writestr(item, new_sheet_xml)
-            elif fn in patched_tables:
-                zout.writestr(item, patched_tables[fn])
-            elif fn.lower() == "[content_types].xml":
-                zout.writestr(item, _strip_calcchain_override(zin.read(fn)))
-            elif fn.lower() == "xl/calcchain.xml":
+    if est_size > 0:
+        out_bio.seek(est_size - 1)
+        out_bio.write(b"\0")
+        out_bio.seek(0)
+    with zipfile.ZipFile(out_bio, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zout:
+        for item in infos:
+            if item.filename.lower() == "xl/calcchain.xml":
                 # Drop calcChain so Excel rebuilds without 'repair'
                 continue
+            member = rewritten.get(item.filename)
+            if member is not None:
+                _append_zip_member(zout, *member)
             else:
-                zout.writestr(item, zin.read(fn))
+                # Untouched part (images, styles, vbaProject, …): copy compressed bytes verbatim
+                _copy_zip_member_raw(zin, zout, item)
     zin.close()
+    out_bio.truncate()   # drop any unused tail of the pre-sized buffer (position = end of archive)
     out_bio.seek(0)
-    return out_bio.getvalue()
+    return out_bio
+
+# ─────────────────────────────────────────────────────────────────────
+# Cached loaders (keyed by content hash, so widget reruns skip re-parsing)
+# ─────────────────────────────────────────────────────────────────────
+def content_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_template_headers(digest: str, _master_bytes: bytes):
+    """(display_headers, secondary_headers, used_cols) of the Template sheet; ValueError if it is missing."""
+    # Header rows come straight from the sheet XML (+ the sharedStrings they use): no openpyxl workbook load
+    with zipfile.ZipFile(io.BytesIO(_master_bytes)) as z:
+        name_index = _zip_name_index(z)
+        try:
+            sheet_path = _find_sheet_part_path(z, name_index, MASTER_TEMPLATE_SHEET)
+        except ValueError:
+            raise ValueError(f"Sheet **'{MASTER_TEMPLATE_SHEET}'** not found in the masterfile.") from None
+        max_try = 2048
+        header_vals = _read_sheet_row_values(z, name_index, sheet_path, (MASTER_DISPLAY_ROW, MASTER_SECONDARY_ROW), max_try)
+    disp_row = header_vals.get(MASTER_DISPLAY_ROW, ())
+    sec_row = header_vals.get(MASTER_SECONDARY_ROW, ())
+    # The same tuples give both the used width and the header texts
+    used_cols = rows_used_cols([disp_row, sec_row], max(len(disp_row), len(sec_row)), empty_streak_stop=8)
+    display_headers   = [v or "" for v in disp_row[:used_cols]] + [""] * (used_cols - len(disp_row))
+    secondary_headers = [v or "" for v in sec_row[:used_cols]] + [""] * (used_cols - len(sec_row))
+    return display_headers, secondary_headers, used_cols
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def pick_best_onboarding_sheet(digest: str, _onboarding_bytes: bytes, alias_groups: tuple):
+    """(df, sheet_name, info) for the sheet whose headers match the most alias groups.
+    Sheets are scored from their header row (plus a short data sample) only; just the winner is parsed."""
+    alias_norms = [{norm(a) for a in aliases} for aliases in alias_groups]
+    best_sheet, best_score, best_matches = None, -1, 0
+    wb_ro = load_workbook(io.BytesIO(_onboarding_bytes), read_only=True, data_only=True)
+    try:
+        for ws in wb_ro.worksheets:
+            try:
+                # Row 1 is the header; rows 2..51 are enough to tell a data sheet from an empty one
+                rows = ws.iter_rows(min_row=1, max_row=51, values_only=True)
+                header = next(rows, ())
+                header_set = {norm(str(v).strip()) for v in header if v is not None}
+                has_rows = any(v is not None and v != "" for row in rows for v in row)
+            except Exception:
+                continue
+            matches = sum(not header_set.isdisjoint(ns) for ns in alias_norms)
+            score = matches + (0.01 if has_rows else 0.0)
+            if score > best_score:
+                best_sheet, best_score, best_matches = ws.title, score, matches
+    finally:
+        wb_ro.close()
+    if best_sheet is None:
+        raise ValueError("No readable onboarding sheet found.")
+    # calamine (Rust) parses the winning sheet only; openpyxl if python-calamine isn't installed
+    try:
+        df = pd.read_excel(io.BytesIO(_onboarding_bytes), sheet_name=best_sheet, header=0, dtype=str, engine="calamine")
+    except ImportError:
+        df = pd.read_excel(io.BytesIO(_onboarding_bytes), sheet_name=best_sheet, header=0, dtype=str, engine="openpyxl")
+    df.columns = [str(c).strip() for c in df.columns]
+    return df, best_sheet, f"matched headers: {best_matches}, non-empty rows: {nonempty_rows(df)}"
 
 # ─────────────────────────────────────────────────────────────────────
 # UI — inputs
@@ -357,6 +834,12 @@ final_name_input = st.text_input(
     value="final_masterfile",
     help="We'll add .xlsx or .xlsm automatically based on your template."
 )
+recalc_on_open = st.checkbox(
+    "Recalculate all formulas when Excel opens the file",
+    value=False,
+    help="Off keeps the template's cached results (fastest to open). "
+         "On makes Excel recompute the whole workbook on first open."
+)
 
 st.markdown("</div>", unsafe_allow_html=True)
 
@@ -412,51 +895,38 @@ if go:
 
     slog("⏳ Reading Template headers…")
     t0 = time.time()
-    wb_ro = load_workbook(io.BytesIO(master_bytes), read_only=True, data_only=True, keep_links=True)
-    if MASTER_TEMPLATE_SHEET not in wb_ro.sheetnames:
-        st.error(f"Sheet **'{MASTER_TEMPLATE_SHEET}'** not found in the masterfile."); st.stop()
-    ws_ro = wb_ro[MASTER_TEMPLATE_SHEET]
-    used_cols = worksheet_used_cols(ws_ro, header_rows=(MASTER_DISPLAY_ROW, MASTER_SECONDARY_ROW), hard_cap=2048, empty_streak_stop=8)
-    display_headers   = [ws_ro.cell(row=MASTER_DISPLAY_ROW,   column=c).value or "" for c in range(1, used_cols+1)]
-    secondary_headers = [ws_ro.cell(row=MASTER_SECONDARY_ROW, column=c).value or "" for c in range(1, used_cols+1)]
-    wb_ro.close()
+    try:
+        display_headers, secondary_headers, used_cols = load_template_headers(content_digest(master_bytes), master_bytes)
+    except ValueError as e:
+        st.error(str(e)); st.stop()
     slog(f"✅ Headers loaded (cols={used_cols}) in {time.time()-t0:.2f}s")
 
     # Pick best onboarding sheet
+    onboarding_file.seek(0)
+    onboarding_bytes = onboarding_file.read()
+    alias_groups = tuple(tuple(aliases) for aliases in mapping_aliases.values())
     try:
-        best_xl = pd.ExcelFile(onboarding_file)
-        best, best_score, best_info = None, -1, ""
-        for sheet in best_xl.sheet_names:
-            try:
-                df = best_xl.parse(sheet_name=sheet, header=0, dtype=str).fillna("")
-                df.columns = [str(c).strip() for c in df.columns]
-            except Exception:
-                continue
-            header_set = {norm(c) for c in df.columns}
-            matches = sum(any(norm(a) in header_set for a in aliases)
-                          for aliases in mapping_aliases.values())
-            rows = nonempty_rows(df)
-            score = matches + (0.01 if rows > 0 else 0.0)
-            if score > best_score:
-                best, best_score = (df, sheet), score
-                best_info = f"matched headers: {matches}, non-empty rows: {rows}"
-        if best is None:
-            raise ValueError("No readable onboarding sheet found.")
-        best_df, best_sheet, info = best[0], best[1], best_info
+        best_df, best_sheet, info = pick_best_onboarding_sheet(content_digest(onboarding_bytes), onboarding_bytes, alias_groups)
     except Exception as e:
         st.error(f"Onboarding error: {e}"); st.stop()
 
-    on_df = best_df.fillna("")
-    on_df.columns = [str(c).strip() for c in on_df.columns]
+    # No fillna() copy: NaN is mapped to "" per mapped column when the block is built
+    on_df = best_df
     on_headers = list(on_df.columns)
+    on_headers_norm = [norm(h) for h in on_headers]   # once; reused for matching and suggestions
     st.success(f"Using onboarding sheet: **{best_sheet}** ({info})")
 
     # Build mapping master col -> source series
-    series_by_alias = {norm(h): on_df[h] for h in on_headers}
     report_lines = ["#### 🔎 Mapping Summary (Template)"]
     BULLET_DISP_N = norm("Key Product Features")
+    LISTING_ACTION_N = norm("Listing Action (List or Unlist)")
     master_to_source = {}
 
+    # Invert the mapping once: normalized alias -> [(alias rank, master header norm, alias)].
+    # Resolution depends only on the master header, so repeated headers are indexed once.
+    master_cols = []
+    alias_to_masters = defaultdict(list)
+    indexed_masters = set()
     for c, (disp, sec) in enumerate(zip(display_headers, secondary_headers), start=1):
         disp_norm = norm(disp); sec_norm = norm(sec)
         if disp_norm == BULLET_DISP_N and sec_norm:
@@ -465,50 +935,66 @@ if go:
             effective_header = disp; label_for_log = disp
         eff_norm = norm(effective_header)
         if not eff_norm: continue
-        aliases = mapping_aliases.get(eff_norm, [effective_header])
-        resolved = None
-        for a in aliases:
-            s = series_by_alias.get(norm(a))
-            if s is not None:
-                resolved = s; break
+        master_cols.append((c, disp_norm, eff_norm, effective_header, label_for_log))
+        if eff_norm in indexed_masters: continue
+        indexed_masters.add(eff_norm)
+        for rank, a in enumerate(mapping_aliases.get(eff_norm, [effective_header])):
+            alias_to_masters[norm(a)].append((rank, eff_norm, a))
+
+    # Single pass over onboarding headers; the earliest alias wins per master header
+    onboard_by_master = {}
+    for h, h_norm in zip(on_headers, on_headers_norm):
+        for rank, m, a in alias_to_masters.get(h_norm, ()):
+            prev = onboard_by_master.get(m)
+            if prev is None or rank <= prev[0]:
+                onboard_by_master[m] = (rank, a, h)
+
+    for c, disp_norm, eff_norm, effective_header, label_for_log in master_cols:
+        resolved = onboard_by_master.get(eff_norm)
         if resolved is not None:
-            master_to_source[c] = resolved
+            _, a, h = resolved
+            if eff_norm not in mapping_aliases: a = effective_header   # unmapped: matched on its own name
+            master_to_source[c] = on_df[h]
             report_lines.append(f"- ✅ **{label_for_log}** ← `{a}`")
         else:
-            if disp_norm == norm("Listing Action (List or Unlist)"):
+            if disp_norm == LISTING_ACTION_N:
                 master_to_source[c] = SENTINEL_LIST
                 report_lines.append(f"- 🟨 **{label_for_log}** ← (will fill `'List'`)")
             else:
-                sugg = top_matches(effective_header, on_headers, 3)
+                sugg = top_matches(effective_header, on_headers, 3, candidates_norm=on_headers_norm)
                 sug_txt = ", ".join(f"`{name}` ({round(sc*100,1)}%)" for sc, name in sugg) if sugg else "*none*"
                 report_lines.append(f"- ❌ **{label_for_log}** ← *no match*. Suggestions: {sug_txt}")
     st.markdown("\n".join(report_lines))
 
     n_rows = len(on_df)
 
-    # Build sanitized 2-D block (dense writer will emit all columns)
-    block = [[""] * used_cols for _ in range(n_rows)]
-    for col, src in master_to_source.items():
-        if src is SENTINEL_LIST:
-            for i in range(n_rows): block[i][col-1] = "List"
-        else:
-            vals = src.astype(str).tolist()
-            m = min(len(vals), n_rows)
-            for i in range(m):
-                v = sanitize_xml_text(vals[i].strip())
-                if v and v.lower() not in ("nan", "none", ""):
-                    block[i][col-1] = v
-
-    # FAST XML write (no fallback)
-    slog("🚀 Writing via fast XML…")
+    # Build sanitized, escaped 2-D block column by column: one list per mapped column,
+    # placed into a preallocated object array (no per-row Python lists).
+    # Columns are independent, so they are cleaned on a thread pool.
+    block_arr = np.full((n_rows, used_cols), "", dtype=object)
+    list_cols = [col-1 for col, src in master_to_source.items() if src is SENTINEL_LIST]
+    mapped = [(col, src) for col, src in master_to_source.items() if src is not SENTINEL_LIST]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(mapped), os.cpu_count() or 1))) as ex:
+        for (col, _), col_vals in zip(mapped, ex.map(lambda item: clean_column_values(item[1], n_rows), mapped)):
+            block_arr[:len(col_vals), col-1] = col_vals
+
+    # Drop rows without any mapped data (blank/trailing onboarding rows) with one mask;
+    # 'List' is filled afterwards so it doesn't keep otherwise-empty rows alive
+    block_arr = block_arr[(block_arr != "").any(axis=1)]
+    block_arr[:, list_cols] = "List"
+    skipped_rows = n_rows - len(block_arr)
+
+    # FAST XML write (no fallback); the writer takes the ndarray as-is
+    slog(f"🚀 Writing {len(block_arr)} rows via fast XML (skipped {skipped_rows} empty)…")
     t_write = time.time()
-    out_bytes = fast_patch_template(
+    out_bio = fast_patch_template(
         master_bytes=master_bytes,
         sheet_name=MASTER_TEMPLATE_SHEET,
         header_row=MASTER_DISPLAY_ROW,
         start_row=MASTER_DATA_START_ROW,
         used_cols=used_cols,
-        block_2d=block
+        block_2d=block_arr,
+        full_calc_on_load=recalc_on_open,
     )
     slog(f"✅ Done in {time.time()-t_write:.2f}s")
 
@@ -518,7 +1004,7 @@ if go:
 
     st.download_button(
         "⬇️ Download Final Masterfile",
-        data=out_bytes,
+        data=out_bio,
         file_name=final_filename,
         mime=out_mime,
         key="dl_final_fast",